@@ -3,17 +3,34 @@
 import argparse
 import os
 import re
+import signal
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from sys import exit
 
 import requests
-from prometheus_client import start_http_server, Summary
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from prometheus_client import start_http_server, Gauge, Summary
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
 
-DEBUG = int(os.environ.get('DEBUG', '0'))
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Debug output is compiled out entirely when running under python -O
+DEBUG = bool(int(os.environ.get('DEBUG', '0')))
 
 COLLECTION_TIME = Summary('jenkins_collector_collect_seconds', 'Time spent to collect metrics from Jenkins')
+HTTP_POOL_AVAILABLE = Gauge('jenkins_http_pool_available', 'Idle connections in the Jenkins API connection pool')
+HTTP_POOL_INUSE = Gauge('jenkins_http_pool_inuse', 'Connections taken from the Jenkins API connection pool')
+HTTP_REQUESTS_INFLIGHT = Gauge('jenkins_http_requests_inflight', 'Jenkins API requests in progress')
+
+SNAKE_CASE_RE = re.compile('([A-Z])')
 
 
 class JenkinsCollector(object):
@@ -21,12 +38,67 @@ class JenkinsCollector(object):
     statuses = ["lastBuild", "lastCompletedBuild", "lastFailedBuild",
                 "lastStableBuild", "lastSuccessfulBuild", "lastUnstableBuild",
                 "lastUnsuccessfulBuild"]
-
-    def __init__(self, target, user, password, insecure):
+    # Job classes which only contain other jobs.
+    folder_classes = ("com.cloudbees.hudson.plugins.folder.Folder",
+                      "jenkins.branch.OrganizationFolder",
+                      "org.jenkinsci.plugins.workflow.multibranch.WorkflowMultiBranchProject")
+    # The metrics we want to export for each build status:
+    # (data key, metric name, help text, divisor applied to the value).
+    status_metrics = (
+        ('number', 'jenkins_job_{0}', 'Jenkins build number for {1}', 1),
+        ('duration', 'jenkins_job_{0}_duration_seconds', 'Jenkins build duration in seconds for {1}', 1000.0),
+        ('timestamp', 'jenkins_job_{0}_timestamp_seconds', 'Jenkins build timestamp in unixtime for {1}', 1000.0),
+        ('queuingDurationMillis', 'jenkins_job_{0}_queuing_duration_seconds',
+         'Jenkins build queuing duration in seconds for {1}', 1000.0),
+        ('totalDurationMillis', 'jenkins_job_{0}_total_duration_seconds',
+         'Jenkins build total duration in seconds for {1}', 1000.0),
+        ('skipCount', 'jenkins_job_{0}_skip_count', 'Jenkins build skip counts for {1}', 1),
+        ('failCount', 'jenkins_job_{0}_fail_count', 'Jenkins build fail counts for {1}', 1),
+        ('totalCount', 'jenkins_job_{0}_total_count', 'Jenkins build total counts for {1}', 1),
+        ('passCount', 'jenkins_job_{0}_pass_count', 'Jenkins build pass counts for {1}', 1),
+    )
+    # Seconds after which all job details are fetched again, even for jobs
+    # without new builds.
+    full_refresh_interval = 300
+    # Maximum number of Jenkins API calls running in parallel.
+    api_workers = 8
+    # Keys of status_metrics read from the build itself and from its actions.
+    build_fields = ('number', 'duration', 'timestamp')
+    action_fields = ('queuingDurationMillis', 'totalDurationMillis', 'skipCount', 'failCount', 'totalCount')
+
+    def __init__(self, target, user, password, insecure, folder_depth=3, cache_ttl=15):
         self._target = target.rstrip("/")
         self._user = user
         self._password = password
         self._insecure = insecure
+        self._folder_depth = folder_depth
+        self._cache_ttl = cache_ttl
+        self._cache = {}
+        self._last_seen = {}
+        self._job_data = {}
+        self._last_full_fetch = 0
+        # Metric names only depend on the status, so format them once
+        self._status_metric_names = {}
+        for status in self.statuses:
+            snake_case = SNAKE_CASE_RE.sub('_\\1', status).lower()
+            self._status_metric_names[status] = [
+                (key, name.format(snake_case, status), help_text.format(snake_case, status))
+                for key, name, help_text, _ in self.status_metrics]
+        divisors = dict((key, divisor) for key, _, _, divisor in self.status_metrics)
+        self._build_fields = [(key, divisors[key]) for key in self.build_fields]
+        self._action_fields = [(key, divisors[key]) for key in self.action_fields]
+
+        # Request exactly the information we need from Jenkins
+        self._jobs_url = '{0}/api/json'.format(self._target)
+        jobs = "[fullName,number,timestamp,duration,actions[queuingDurationMillis,totalDurationMillis," \
+               "skipCount,failCount,totalCount,passCount]]"
+        job_tree = 'fullName,url,builds[number,result],{0}'.format(','.join([s + jobs for s in self.statuses]))
+        probe_tree = 'fullName,url,lastBuild[number],lastCompletedBuild[number]'
+        self._job_detail_params = {'tree': job_tree}
+        self._jobs_params = {'tree': self._nested_tree(job_tree)}
+        self._probe_params = {'tree': self._nested_tree(probe_tree)}
+
+        self._session = self._create_session()
 
     def collect(self):
         start = time.time()
@@ -38,117 +110,213 @@ class JenkinsCollector(object):
 
         for job in jobs:
             name = job['fullName']
-            if DEBUG:
+            if __debug__ and DEBUG:
                 print("Found Job: {}".format(name))
                 pprint(job)
             self._get_metrics(name, job)
 
+        # Skip metrics without samples, there is nothing to expose for them
+        metrics = []
         for status in self.statuses:
-            for metric in self._prometheus_metrics[status].values():
-                yield metric
-
-        for metric in self._job_runs_metrics.values():
-            yield metric
+            metrics.extend([metric for metric in self._prometheus_metrics[status].values() if metric.samples])
+        metrics.extend([metric for metric in self._job_runs_metrics.values() if metric.samples])
 
         duration = time.time() - start
         COLLECTION_TIME.observe(duration)
+        return metrics
 
-    def _api_call(self, url, params):
+    def _create_session(self):
+        # Keep connections to Jenkins alive between API calls instead of
+        # doing a new TCP/TLS handshake for every request.
+        session = requests.Session()
         if self._user and self._password:
-            response = requests.get(url, params=params, auth=(self._user, self._password), verify=(not self._insecure))
-        else:
-            response = requests.get(url, params=params, verify=(not self._insecure))
-        if DEBUG:
+            session.auth = (self._user, self._password)
+        self._adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                                    max_retries=Retry(total=2, backoff_factor=0.2))
+        session.mount('http://', self._adapter)
+        session.mount('https://', self._adapter)
+        return session
+
+    def _pool_stats(self):
+        # Count idle and taken connections over the per-host urllib3 pools.
+        # This reads urllib3 internals, so report NaN rather than failing the
+        # whole exposition if they change.
+        try:
+            pools = self._adapter.poolmanager.pools
+            with pools.lock:
+                connection_pools = list(pools._container.values())
+            available = inuse = 0
+            for connection_pool in connection_pools:
+                queue = connection_pool.pool
+                if queue is None:
+                    continue
+                available += sum(1 for conn in list(queue.queue) if conn is not None)
+                inuse += queue.maxsize - queue.qsize()
+        except Exception:
+            return float('nan'), float('nan')
+        return available, inuse
+
+    def _api_call(self, url, params):
+        # Serve repeated scrapes within the TTL from the response cache
+        key = (url, tuple(sorted(params.items())))
+        cached = self._cache.get(key)
+        if cached and time.time() - cached[0] < self._cache_ttl:
+            return cached[1]
+
+        with HTTP_REQUESTS_INFLIGHT.track_inprogress():
+            # verify is passed per request: a session-level verify=False is
+            # overridden by REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE.
+            response = self._session.get(url, params=params, verify=(not self._insecure), timeout=(3.05, 30))
+        if __debug__ and DEBUG:
             pprint(response.text)
         if response.status_code != requests.codes.ok:
             raise Exception("Call to url %s failed with status: %s" % (url, response.status_code))
-        result = response.json()
-        if DEBUG:
+        result = json_loads(response.content)
+        if __debug__ and DEBUG:
             pprint(result)
 
+        if self._cache_ttl > 0:
+            self._cache[key] = (time.time(), result)
         return result
 
+    def _evict_cache(self):
+        # Drop expired entries, e.g. urls of deleted jobs and folders. A
+        # response cached concurrently may be lost, which only costs a miss.
+        now = time.time()
+        self._cache = dict((key, entry) for key, entry in list(self._cache.items())
+                           if now - entry[0] < self._cache_ttl)
+
     def parse_job_runs(self, job):
         workflow_runs = {}
         if job['_class'] == 'org.jenkinsci.plugins.workflow.job.WorkflowJob' or job['_class'] == 'hudson.model.FreeStyleProject':
             builds = job.get('builds', [])
             if builds:
-                successful_runs = []
-                failed_runs = []
+                # Build results are requested inline via the tree parameter,
+                # so no extra API call per build is needed.
+                successful_runs = 0
+                failed_runs = 0
                 for workflow_run in builds:
-                    wf_data = self._api_call(workflow_run['url'] + 'api/json', {})
-                    if wf_data['result'] == 'SUCCESS':
-                        successful_runs.append(wf_data['number'])
-                    if wf_data['result'] == 'FAILURE':
-                        failed_runs.append(wf_data['number'])
+                    if workflow_run.get('result') == 'SUCCESS':
+                        successful_runs += 1
+                    elif workflow_run.get('result') == 'FAILURE':
+                        failed_runs += 1
 
                 workflow_runs.update(
-                    {'runs_successful_total': len(successful_runs),
-                     'runs_failed_total': len(failed_runs)})
+                    {'runs_successful_total': successful_runs,
+                     'runs_failed_total': failed_runs})
                 job.update(workflow_runs)
 
     def parse_jobs(self, url, params):
+        jobs = self._list_jobs(url, params)
+        for job in jobs:
+            self.parse_job_runs(job)
+        return jobs
+
+    def _api_calls(self, urls, params, skip_errors=False):
+        # Independent API calls share the session's connection pool, so run
+        # them in parallel. With skip_errors failed calls return None.
+        def api_call(url):
+            try:
+                return self._api_call(url, params)
+            except Exception as e:
+                if not skip_errors:
+                    raise
+                print("Skipping {0}: {1}".format(url, e))
+                return None
+
+        if len(urls) < 2:
+            return [api_call(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=self.api_workers) as executor:
+            return list(executor.map(api_call, urls))
+
+    def _list_jobs(self, url, params):
         result = self._api_call(url, params)
         jobs = []
-        for job in result['jobs']:
-            if job['_class'] == 'com.cloudbees.hudson.plugins.folder.Folder' or \
-                    job['_class'] == 'jenkins.branch.OrganizationFolder' or \
-                    job['_class'] == 'org.jenkinsci.plugins.workflow.multibranch.WorkflowMultiBranchProject':
-                jobs += self.parse_jobs(job['url'] + '/api/json', params)
-            else:
-                self.parse_job_runs(job)
-                jobs.append(job)
+        pending = deque(result['jobs'])
+        while pending:
+            unexpanded = []
+            while pending:
+                job = pending.popleft()
+                if job['_class'] in self.folder_classes:
+                    if 'jobs' in job:
+                        pending.extend(job['jobs'])
+                    else:
+                        unexpanded.append(job['url'] + '/api/json')
+                else:
+                    jobs.append(job)
+            # Folders nested deeper than the tree query reaches
+            for folder in self._api_calls(unexpanded, params):
+                pending.extend(folder['jobs'])
         return jobs
 
+    @staticmethod
+    def _job_version(job):
+        # Changes whenever a build is started or finished
+        return tuple((job.get(status) or {}).get('number') for status in ('lastBuild', 'lastCompletedBuild'))
+
+    def _nested_tree(self, job_tree):
+        # Fetch nested folders in the same call, up to the configured depth
+        nested_tree = job_tree
+        for _ in range(self._folder_depth):
+            nested_tree = '{0},jobs[{1}]'.format(job_tree, nested_tree)
+        return 'jobs[{0}]'.format(nested_tree)
+
     def _request_data(self):
-        # Request exactly the information we need from Jenkins
-        url = '{0}/api/json'.format(self._target)
-        jobs = "[fullName,number,timestamp,duration,actions[queuingDurationMillis,totalDurationMillis," \
-               "skipCount,failCount,totalCount,passCount]]"
-        tree = 'jobs[fullName,url,builds[url],{0}]'.format(','.join([s + jobs for s in self.statuses]))
-        params = {
-            'tree': tree,
-        }
+        self._evict_cache()
+
+        # Builds can also be deleted or get actions attached after they
+        # finished, so refresh everything once in a while.
+        if time.time() - self._last_full_fetch >= self.full_refresh_interval:
+            return self._request_all_data()
+
+        # First only ask which jobs had a build started or finished since the
+        # last scrape, then fetch details for those jobs alone.
+        probe = self._list_jobs(self._jobs_url, self._probe_params)
+        changed = [job for job in probe
+                   if self._last_seen.get(job['fullName']) != self._job_version(job)]
+        if len(changed) * 2 > len(probe):
+            # When most jobs changed, one nested call is cheaper than one per job
+            return self._request_all_data()
+
+        job_data = dict((job['fullName'], self._job_data[job['fullName']]) for job in probe
+                        if job['fullName'] in self._job_data)
+        # A job can disappear after the probe, e.g. a deleted branch. Drop
+        # it for this scrape instead of failing the whole collection.
+        details = self._api_calls([job['url'] + '/api/json' for job in changed], self._job_detail_params,
+                                  skip_errors=True)
+        for job, detail in zip(changed, details):
+            if detail is None:
+                job_data.pop(job['fullName'], None)
+                continue
+            self.parse_job_runs(detail)
+            job_data[job['fullName']] = detail
+
+        self._remember_job_data(job_data)
+        return [job_data[job['fullName']] for job in probe if job['fullName'] in job_data]
+
+    def _request_all_data(self):
+        start = time.time()
+        jobs = self.parse_jobs(self._jobs_url, self._jobs_params)
+        self._remember_job_data(dict((job['fullName'], job) for job in jobs))
+        self._last_full_fetch = start
+        return jobs
 
-        jobs_data = self.parse_jobs(url, params)
-        return jobs_data
+    def _remember_job_data(self, job_data):
+        # Remember the version of the data we actually hold, so stale details
+        # are fetched again on the next scrape.
+        self._job_data = job_data
+        self._last_seen = dict((name, self._job_version(job)) for name, job in job_data.items())
 
     def _setup_empty_prometheus_metrics(self):
         # The metrics we want to export.
         self._prometheus_metrics = {}
+        self._adders = {}
         for status in self.statuses:
-            snake_case = re.sub('([A-Z])', '_\\1', status).lower()
-            self._prometheus_metrics[status] = {
-                'number':
-                    GaugeMetricFamily('jenkins_job_{0}'.format(snake_case),
-                                      'Jenkins build number for {0}'.format(status), labels=["jobname"]),
-                'duration':
-                    GaugeMetricFamily('jenkins_job_{0}_duration_seconds'.format(snake_case),
-                                      'Jenkins build duration in seconds for {0}'.format(status), labels=["jobname"]),
-                'timestamp':
-                    GaugeMetricFamily('jenkins_job_{0}_timestamp_seconds'.format(snake_case),
-                                      'Jenkins build timestamp in unixtime for {0}'.format(status), labels=["jobname"]),
-                'queuingDurationMillis':
-                    GaugeMetricFamily('jenkins_job_{0}_queuing_duration_seconds'.format(snake_case),
-                                      'Jenkins build queuing duration in seconds for {0}'.format(status),
-                                      labels=["jobname"]),
-                'totalDurationMillis':
-                    GaugeMetricFamily('jenkins_job_{0}_total_duration_seconds'.format(snake_case),
-                                      'Jenkins build total duration in seconds for {0}'.format(status),
-                                      labels=["jobname"]),
-                'skipCount':
-                    GaugeMetricFamily('jenkins_job_{0}_skip_count'.format(snake_case),
-                                      'Jenkins build skip counts for {0}'.format(status), labels=["jobname"]),
-                'failCount':
-                    GaugeMetricFamily('jenkins_job_{0}_fail_count'.format(snake_case),
-                                      'Jenkins build fail counts for {0}'.format(status), labels=["jobname"]),
-                'totalCount':
-                    GaugeMetricFamily('jenkins_job_{0}_total_count'.format(snake_case),
-                                      'Jenkins build total counts for {0}'.format(status), labels=["jobname"]),
-                'passCount':
-                    GaugeMetricFamily('jenkins_job_{0}_pass_count'.format(snake_case),
-                                      'Jenkins build pass counts for {0}'.format(status), labels=["jobname"]),
-            }
+            metrics = dict(
+                (key, GaugeMetricFamily(name, help_text, labels=["jobname"]))
+                for key, name, help_text in self._status_metric_names[status])
+            self._prometheus_metrics[status] = metrics
+            self._adders[status] = self._make_adder(metrics)
 
         self._job_runs_metrics = {}
         self._job_runs_metrics = {
@@ -159,42 +327,48 @@ class JenkinsCollector(object):
         }
 
     def _get_metrics(self, name, job):
+        adders = self._adders
         for status in self.statuses:
-            if status in job.keys():
-                status_data = job[status] or {}
-                self._add_data_to_prometheus_structure(status, status_data, job, name)
-
-    def _add_data_to_prometheus_structure(self, status, status_data, job, name):
-        # If there's a null result, we want to pass.
-        if status_data.get('duration', 0):
-            self._prometheus_metrics[status]['duration'].add_metric([name], status_data.get('duration') / 1000.0)
-        if status_data.get('timestamp', 0):
-            self._prometheus_metrics[status]['timestamp'].add_metric([name], status_data.get('timestamp') / 1000.0)
-        if status_data.get('number', 0):
-            self._prometheus_metrics[status]['number'].add_metric([name], status_data.get('number'))
-        actions_metrics = status_data.get('actions', [{}])
-        for metric in actions_metrics:
-            if metric.get('queuingDurationMillis', False):
-                self._prometheus_metrics[status]['queuingDurationMillis'].add_metric([name], metric.get(
-                    'queuingDurationMillis') / 1000.0)
-            if metric.get('totalDurationMillis', False):
-                self._prometheus_metrics[status]['totalDurationMillis'].add_metric([name], metric.get(
-                    'totalDurationMillis') / 1000.0)
-            if metric.get('skipCount', False):
-                self._prometheus_metrics[status]['skipCount'].add_metric([name], metric.get('skipCount'))
-            if metric.get('failCount', False):
-                self._prometheus_metrics[status]['failCount'].add_metric([name], metric.get('failCount'))
-            if metric.get('totalCount', False):
-                self._prometheus_metrics[status]['totalCount'].add_metric([name], metric.get('totalCount'))
-                # Calculate passCount by subtracting fails and skips from totalCount
-                passcount = metric.get('totalCount') - metric.get('failCount') - metric.get('skipCount')
-                self._prometheus_metrics[status]['passCount'].add_metric([name], passcount)
+            # Missing and null statuses have no data to add
+            status_data = job.get(status)
+            if status_data:
+                adders[status](name, status_data)
 
         if job.get('runs_successful_total', 0):
             self._job_runs_metrics['runs_successful_total'].add_metric([name], job.get('runs_successful_total'))
         if job.get('runs_failed_total', 0):
             self._job_runs_metrics['runs_failed_total'].add_metric([name], job.get('runs_failed_total'))
 
+    def _make_adder(self, metrics):
+        # Returns a function adding one build's data to the given status
+        # metrics, with the add_metric methods resolved up front.
+        build_fields = [(key, divisor, metrics[key].add_metric) for key, divisor in self._build_fields]
+        action_fields = [(key, divisor, metrics[key].add_metric) for key, divisor in self._action_fields]
+        add_pass_count = metrics['passCount'].add_metric
+
+        def add(name, status_data):
+            labels = [name]
+            # If there's a null result, we want to pass.
+            status_get = status_data.get
+            for key, divisor, add_metric in build_fields:
+                value = status_get(key)
+                if value:
+                    add_metric(labels, value / divisor)
+            for metric in status_get('actions') or ():
+                metric_get = metric.get
+                for key, divisor, add_metric in action_fields:
+                    value = metric_get(key)
+                    if value:
+                        add_metric(labels, value / divisor)
+                total_count = metric_get('totalCount')
+                if total_count:
+                    # Calculate passCount by subtracting fails and skips from totalCount
+                    fail_count = metric_get('failCount') or 0
+                    skip_count = metric_get('skipCount') or 0
+                    add_pass_count(labels, total_count - fail_count - skip_count)
+
+        return add
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -237,6 +411,22 @@ def parse_args():
         help='Allow connection to insecure Jenkins API',
         default=False
     )
+    parser.add_argument(
+        '--folder-depth',
+        metavar='depth',
+        required=False,
+        type=int,
+        help='Fetch jobs of nested folders up to this depth in a single call',
+        default=int(os.environ.get('JENKINS_FOLDER_DEPTH', '3'))
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        metavar='seconds',
+        required=False,
+        type=int,
+        help='Reuse Jenkins API responses for this many seconds, 0 disables caching',
+        default=int(os.environ.get('JENKINS_CACHE_TTL', '15'))
+    )
     return parser.parse_args()
 
 
@@ -244,11 +434,19 @@ def main():
     try:
         args = parse_args()
         port = int(args.port)
-        REGISTRY.register(JenkinsCollector(args.jenkins, args.user, args.password, args.insecure))
+        collector = JenkinsCollector(args.jenkins, args.user, args.password, args.insecure,
+                                     args.folder_depth, args.cache_ttl)
+        HTTP_POOL_AVAILABLE.set_function(lambda: collector._pool_stats()[0])
+        HTTP_POOL_INUSE.set_function(lambda: collector._pool_stats()[1])
+        REGISTRY.register(collector)
         start_http_server(port)
         print("Polling {}. Serving at port: {}".format(args.jenkins, port))
+        # Sleep until a signal arrives, the HTTP server runs in its own thread
         while True:
-            time.sleep(1)
+            if hasattr(signal, 'pause'):
+                signal.pause()
+            else:
+                threading.Event().wait()
     except KeyboardInterrupt:
         print(" Interrupted")
         exit(0)
@@ -1,6 +1,17 @@
 #!/usr/bin/python
 
+import math
+import threading
+import time
 import unittest
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+import jenkins_exporter
 from jenkins_exporter import JenkinsCollector
 
 
@@ -16,6 +27,250 @@ class JenkinsCollectorTestCase(unittest.TestCase):
         self.assertTrue(hasattr(exporter, '_prometheus_metrics'))
         self.assertEqual(sorted(exporter._prometheus_metrics.keys()), sorted(JenkinsCollector.statuses))
 
+    def test_parse_job_runs(self):
+        exporter = JenkinsCollector('', '', '', False)
+        job = {
+            '_class': 'org.jenkinsci.plugins.workflow.job.WorkflowJob',
+            'builds': [{'number': 3, 'result': 'SUCCESS'},
+                       {'number': 2, 'result': 'FAILURE'},
+                       {'number': 1, 'result': 'SUCCESS'},
+                       {'number': 4, 'result': None}],
+        }
+        exporter.parse_job_runs(job)
+        self.assertEqual(job['runs_successful_total'], 2)
+        self.assertEqual(job['runs_failed_total'], 1)
+
+    def test_parse_jobs_nested_folders(self):
+        exporter = JenkinsCollector('', '', '', False, folder_depth=1)
+        folder = 'com.cloudbees.hudson.plugins.folder.Folder'
+        freestyle = 'hudson.model.FreeStyleProject'
+        responses = {
+            'http://jenkins/api/json': {'jobs': [
+                {'_class': freestyle, 'fullName': 'top'},
+                {'_class': folder, 'url': 'http://jenkins/job/a', 'jobs': [
+                    {'_class': freestyle, 'fullName': 'a/nested'},
+                    {'_class': folder, 'url': 'http://jenkins/job/a/job/b'},
+                ]},
+            ]},
+            'http://jenkins/job/a/job/b/api/json': {'jobs': [
+                {'_class': freestyle, 'fullName': 'a/b/deep'},
+            ]},
+        }
+        exporter._api_call = lambda url, params: responses[url]
+        jobs = exporter.parse_jobs('http://jenkins/api/json', {})
+        self.assertEqual([job['fullName'] for job in jobs], ['top', 'a/nested', 'a/b/deep'])
+
+    def test_parse_jobs_parallel_folders(self):
+        exporter = JenkinsCollector('', '', '', False, folder_depth=0)
+        folder = 'com.cloudbees.hudson.plugins.folder.Folder'
+        freestyle = 'hudson.model.FreeStyleProject'
+        responses = {
+            'http://jenkins/api/json': {'jobs': [
+                {'_class': folder, 'url': 'http://jenkins/job/a'},
+                {'_class': folder, 'url': 'http://jenkins/job/b'},
+            ]},
+            'http://jenkins/job/a/api/json': {'jobs': [
+                {'_class': freestyle, 'fullName': 'a/1'},
+                {'_class': folder, 'url': 'http://jenkins/job/a/job/c'},
+            ]},
+            'http://jenkins/job/b/api/json': {'jobs': [
+                {'_class': freestyle, 'fullName': 'b/1'},
+                {'_class': folder, 'url': 'http://jenkins/job/b/job/d'},
+            ]},
+            'http://jenkins/job/a/job/c/api/json': {'jobs': [{'_class': freestyle, 'fullName': 'a/c/1'}]},
+            'http://jenkins/job/b/job/d/api/json': {'jobs': [{'_class': freestyle, 'fullName': 'b/d/1'}]},
+        }
+
+        def api_call(url, params):
+            # Let the first folders of each level finish last
+            if url in ('http://jenkins/job/a/api/json', 'http://jenkins/job/a/job/c/api/json'):
+                time.sleep(0.05)
+            return responses[url]
+
+        exporter._api_call = api_call
+        jobs = exporter.parse_jobs('http://jenkins/api/json', {})
+        self.assertEqual([job['fullName'] for job in jobs], ['a/1', 'b/1', 'a/c/1', 'b/d/1'])
+
+    def test_request_data_fetches_changed_jobs_only(self):
+        exporter = JenkinsCollector('http://jenkins', '', '', False)
+        freestyle = 'hudson.model.FreeStyleProject'
+        builds = {'a': 1, 'b': 1, 'c': 1}
+        calls = []
+
+        def api_call(url, params):
+            calls.append(url)
+            if url == 'http://jenkins/api/json':
+                full = 'builds' in params['tree']
+                return {'jobs': [dict({'_class': freestyle, 'fullName': name, 'url': 'http://jenkins/job/' + name,
+                                       'lastBuild': {'number': number}, 'lastCompletedBuild': {'number': number}},
+                                      **({'builds': [{'number': number, 'result': 'SUCCESS'}]} if full else {}))
+                                 for name, number in sorted(builds.items())]}
+            name = url.split('/')[-3]
+            return {'_class': freestyle, 'fullName': name, 'url': 'http://jenkins/job/' + name,
+                    'builds': [{'number': builds[name], 'result': 'FAILURE'}],
+                    'lastBuild': {'number': builds[name]}, 'lastCompletedBuild': {'number': builds[name]}}
+
+        exporter._api_call = api_call
+        # The first scrape fetches everything without probing
+        jobs = exporter._request_data()
+        self.assertEqual(calls, ['http://jenkins/api/json'])
+        self.assertEqual([job['fullName'] for job in jobs], ['a', 'b', 'c'])
+
+        del calls[:]
+        builds['b'] = 2
+        jobs = exporter._request_data()
+        self.assertEqual(calls, ['http://jenkins/api/json', 'http://jenkins/job/b/api/json'])
+        self.assertEqual([job['fullName'] for job in jobs], ['a', 'b', 'c'])
+        self.assertEqual(jobs[0]['runs_successful_total'], 1)
+        self.assertEqual(jobs[1]['runs_failed_total'], 1)
+
+        # Unchanged jobs are fetched again once the full refresh interval passed
+        del calls[:]
+        exporter._last_full_fetch -= JenkinsCollector.full_refresh_interval
+        jobs = exporter._request_data()
+        self.assertEqual(calls, ['http://jenkins/api/json'])
+        self.assertEqual([job['runs_successful_total'] for job in jobs], [1, 1, 1])
+
+        # When most jobs changed the probe is followed by one full fetch
+        del calls[:]
+        builds['a'] = 3
+        builds['c'] = 3
+        jobs = exporter._request_data()
+        self.assertEqual(calls, ['http://jenkins/api/json'] * 2)
+        self.assertEqual([job['lastBuild']['number'] for job in jobs], [3, 2, 3])
+
+    def test_api_call_cache(self):
+        class Response(object):
+            status_code = 200
+            content = b'{"jobs": []}'
+
+        class Clock(object):
+            now = 0
+
+            def time(self):
+                return self.now
+
+        params = {'tree': 'jobs'}
+        for cache_ttl, expected_calls in ((15, ['a', 'c', 'b', 'a']), (0, ['a', 'c', 'a', 'b', 'a'])):
+            exporter = JenkinsCollector('', '', '', False, cache_ttl=cache_ttl)
+            calls = []
+            exporter._session.get = lambda url, **kwargs: calls.append(url) or Response()
+            clock = Clock()
+            original_time, jenkins_exporter.time = jenkins_exporter.time, clock
+            try:
+                clock.now = 100
+                exporter._api_call('a', params)
+                exporter._api_call('c', params)
+                clock.now = 110
+                exporter._api_call('a', params)
+                exporter._api_call('b', params)
+                clock.now = 120
+                self.assertEqual(exporter._api_call('a', params), {'jobs': []})
+                exporter._evict_cache()
+            finally:
+                jenkins_exporter.time = original_time
+            self.assertEqual(calls, expected_calls)
+            if cache_ttl:
+                # Expired entries are dropped, 'b' is still fresh
+                self.assertEqual(sorted(exporter._cache.items()),
+                                 [(('a', (('tree', 'jobs'),)), (120, {'jobs': []})),
+                                  (('b', (('tree', 'jobs'),)), (110, {'jobs': []}))])
+            else:
+                self.assertEqual(exporter._cache, {})
+
+    def test_pool_stats(self):
+        class Handler(SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            exporter = JenkinsCollector('', '', '', False)
+            self.assertEqual(exporter._pool_stats(), (0, 0))
+            response = exporter._session.get('http://127.0.0.1:{0}/'.format(server.server_port))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(exporter._pool_stats(), (1, 0))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # Unreadable pool internals must not break the exposition
+        exporter._adapter = None
+        self.assertTrue(all(math.isnan(value) for value in exporter._pool_stats()))
+
+    def test_collect(self):
+        exporter = JenkinsCollector('', '', '', False)
+        build = {'number': 7, 'duration': 1500, 'timestamp': 1000000}
+        exporter._request_data = lambda: [{'fullName': 'job', 'lastBuild': build, 'lastUnstableBuild': None,
+                                           'runs_successful_total': 3}]
+        metrics = exporter.collect()
+        self.assertIsInstance(metrics, list)
+        names = [metric.name for metric in metrics]
+        self.assertEqual(sorted(names), ['jenkins_job_last_build', 'jenkins_job_last_build_duration_seconds',
+                                         'jenkins_job_last_build_timestamp_seconds', 'jenkins_runs_successful_total'])
+        self.assertFalse([name for name in names if name.startswith('jenkins_job_last_unstable_build')])
+
+    def test_request_data_parallel_details(self):
+        exporter = JenkinsCollector('http://jenkins', '', '', False)
+        freestyle = 'hudson.model.FreeStyleProject'
+        builds = {'a': 1, 'b': 1, 'c': 1, 'd': 1, 'e': 1, 'f': 1}
+        missing = set()
+
+        def api_call(url, params):
+            if url == 'http://jenkins/api/json':
+                return {'jobs': [{'_class': freestyle, 'fullName': name, 'url': 'http://jenkins/job/' + name,
+                                  'lastBuild': {'number': number}, 'lastCompletedBuild': {'number': number}}
+                                 for name, number in sorted(builds.items())]}
+            name = url.split('/')[-3]
+            if name in missing:
+                raise Exception("Call to url %s failed with status: 404" % url)
+            if name == 'a':
+                # Finish the first detail call last
+                time.sleep(0.05)
+            return {'_class': freestyle, 'fullName': name, 'url': 'http://jenkins/job/' + name,
+                    'builds': [{'number': number, 'result': 'FAILURE'} for number in range(builds[name])],
+                    'lastBuild': {'number': builds[name]}, 'lastCompletedBuild': {'number': builds[name]}}
+
+        exporter._api_call = api_call
+        exporter._request_data()
+        builds['a'] = 2
+        builds['b'] = 3
+        builds['c'] = 2
+        missing.add('c')
+        jobs = exporter._request_data()
+        self.assertEqual([job['fullName'] for job in jobs], ['a', 'b', 'd', 'e', 'f'])
+        self.assertEqual([job.get('runs_failed_total') for job in jobs[:2]], [2, 3])
+
+        # The failed job is fetched again on the next scrape
+        missing.clear()
+        jobs = exporter._request_data()
+        self.assertEqual([job['fullName'] for job in jobs], ['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertEqual(jobs[2]['runs_failed_total'], 2)
+
+    def test_get_metrics(self):
+        exporter = JenkinsCollector('', '', '', False)
+        exporter._setup_empty_prometheus_metrics()
+        build = {'number': 7, 'duration': 1500, 'timestamp': 1000000,
+                 'actions': [{}, {'failCount': 1, 'skipCount': 2, 'totalCount': 10}]}
+        job = {'lastBuild': build, 'lastSuccessfulBuild': build, 'lastFailedBuild': None,
+               'runs_successful_total': 3}
+        exporter._get_metrics('job', job)
+
+        def values(metric):
+            return [(sample.labels, sample.value) for sample in metric.samples]
+
+        metrics = exporter._prometheus_metrics['lastBuild']
+        self.assertEqual(values(metrics['number']), [({'jobname': 'job'}, 7)])
+        self.assertEqual(values(metrics['duration']), [({'jobname': 'job'}, 1.5)])
+        self.assertEqual(values(metrics['timestamp']), [({'jobname': 'job'}, 1000.0)])
+        self.assertEqual(values(metrics['queuingDurationMillis']), [])
+        self.assertEqual(values(metrics['passCount']), [({'jobname': 'job'}, 7)])
+        self.assertEqual(values(exporter._prometheus_metrics['lastFailedBuild']['number']), [])
+        self.assertEqual(values(exporter._job_runs_metrics['runs_successful_total']), [({'jobname': 'job'}, 3)])
+
 
 if __name__ == "__main__":
     unittest.main()